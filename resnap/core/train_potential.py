@@ -11,10 +11,28 @@ structural bispectrum terms and energy.
 
 import numpy as np
 import matplotlib.pyplot as plt
+
+try:
+    # Must run before sklearn.linear_model is imported so that the
+    # patched MKL-backed estimators are picked up below.
+    from sklearnex import patch_sklearn
+    patch_sklearn(verbose=False)
+except ImportError:
+    pass
+
 import sklearn.linear_model
-from sklearn.preprocessing import normalize
 from scipy import io
+from scipy import linalg
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 import os
+import warnings
+
+try:
+    from numba import njit, prange
+    numba_loaded = True
+except ImportError:
+    numba_loaded = False
 
 __author__ = "Tingzheng Hou and Lu Jiang"
 __copyright__ = "Copyright 2020, Tingzheng Hou and Lu Jiang"
@@ -26,10 +44,89 @@ __date__ = "May 3, 2020"
 MODELS = {"LASSO": sklearn.linear_model.Lasso,
           "RIDGE": sklearn.linear_model.Ridge}
 
+if numba_loaded:
+    @njit(cache=True, fastmath=True)
+    def _mean_abs_rel_err(y_true, y_pred, n_atoms):
+        """
+        Mean absolute error per atom, fused into a single pass
+        without intermediate arrays.
+
+        Args:
+            y_true (numpy.ndarray): true labels.
+            y_pred (numpy.ndarray): predicted labels.
+            n_atoms (numpy.ndarray): number of atoms in each sample.
+
+        Returns:
+            The mean absolute per-atom error.
+
+        """
+        total = 0.0
+        for k in range(y_true.shape[0]):
+            total += abs(y_true[k] - y_pred[k]) / n_atoms[k]
+        return total / y_true.shape[0]
+
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _path_errors(y_true, y_hat, n_atoms):
+        """
+        Mean absolute error per atom for each column of a prediction
+        matrix, fused into one pass and parallelized over alphas.
+
+        Args:
+            y_true (numpy.ndarray): true labels.
+            y_hat (numpy.ndarray): (n_samples, n_alphas) predictions.
+            n_atoms (numpy.ndarray): number of atoms in each sample.
+
+        Returns:
+            A numpy array of per-alpha mean absolute per-atom errors.
+
+        """
+        n, n_alphas = y_hat.shape
+        errors = np.empty(n_alphas)
+        for j in prange(n_alphas):
+            total = 0.0
+            for k in range(n):
+                total += abs(y_true[k] - y_hat[k, j]) / n_atoms[k]
+            errors[j] = total / n
+        return errors
+else:
+    def _mean_abs_rel_err(y_true, y_pred, n_atoms):
+        """
+        Mean absolute error per atom. NumPy fallback used when numba
+        is not installed.
+
+        Args:
+            y_true (numpy.ndarray): true labels.
+            y_pred (numpy.ndarray): predicted labels.
+            n_atoms (numpy.ndarray): number of atoms in each sample.
+
+        Returns:
+            The mean absolute per-atom error.
+
+        """
+        return np.average(np.absolute(y_true - y_pred) / n_atoms)
+
+    def _path_errors(y_true, y_hat, n_atoms):
+        """
+        Mean absolute error per atom for each column of a prediction
+        matrix. NumPy fallback used when numba is not installed.
+
+        Args:
+            y_true (numpy.ndarray): true labels.
+            y_hat (numpy.ndarray): (n_samples, n_alphas) predictions.
+            n_atoms (numpy.ndarray): number of atoms in each sample.
+
+        Returns:
+            A numpy array of per-alpha mean absolute per-atom errors.
+
+        """
+        diff = np.absolute(y_true[:, None] - y_hat)
+        return np.average(diff / n_atoms[:, None], axis=0)
+
 
 class PotentialTrainer:
 
-    def __init__(self, data_dir, f, norm=None):
+    def __init__(self, data_dir, f, norm=None, blas_threads=None,
+                 dtype=None):
         """
         Base constructor.
 
@@ -38,25 +135,78 @@ class PotentialTrainer:
             f (func): training model function.
             norm (str): The norm to use to normalize features. If
                 None, apply no normalization.
+            blas_threads (int): Number of BLAS threads each model fit
+                may use. If None, cross validation divides the
+                available cores over the 5 parallel folds and
+                make_potential uses the BLAS default.
+            dtype (numpy.dtype): dtype used to store the training data.
+                numpy.float32 halves the memory traffic of the fits at
+                the cost of precision. If None, keep the float64 data
+                loaded from the .mat file.
 
         """
         self.data_dir = data_dir
         self.f = MODELS.get(f)
-        data = io.loadmat(self.data_dir)
-        for data_name in ["X", "y"]:
+        self.blas_threads = blas_threads
+        self.dtype = dtype
+        self.training_x, self.training_y = self._load_data()
+        for data_name, array in [("X", self.training_x),
+                                 ("y", self.training_y)]:
             print("\nloaded %s data!" % data_name)
-            print(data[data_name].shape)
-        self.training_x = data.get('X')
+            print(array.shape)
+        if self.dtype is not None:
+            self.training_x = self.training_x.astype(self.dtype)
+            self.training_y = self.training_y.astype(self.dtype)
+        if self.dtype == np.float32:
+            condition = np.linalg.cond(self.training_x)
+            # The normal equations square the conditioning, so float32
+            # is only safe while cond(X)^2 stays below 1/eps(float32).
+            if condition > 1.0 / np.sqrt(np.finfo(np.float32).eps):
+                warnings.warn("Feature matrix condition number {:.3g} "
+                              "may be too large for float32 "
+                              "fits.".format(condition))
+        # Column-major storage feeds LAPACK/BLAS without the hidden
+        # transpose copies the fits would otherwise make.
+        self.training_x = np.asfortranarray(self.training_x)
         self.norm = norm
         if self.norm:
+            # Normalization writes back into the feature block, which a
+            # memory-mapped cache loaded read-only does not allow.
+            if not self.training_x.flags.writeable:
+                self.training_x = self.training_x.copy(order='F')
             features = self.training_x[:, 1:]
-            features, norms = normalize(features, norm=self.norm,
-                                        axis=0, copy=True, return_norm=True)
+            norm_ord = {"l1": 1, "l2": 2, "max": np.inf}[self.norm]
+            norms = np.linalg.norm(features, ord=norm_ord, axis=0)
+            norms[norms == 0] = 1.0
             self.norms = norms
-            self.training_x[:, 1:] = features
-        self.training_y = data.get('y')
-        self.training_data = \
-            np.concatenate((self.training_y, self.training_x), axis=1)
+            features /= norms
+
+    def _load_data(self):
+        """
+        Load the training arrays, caching the parsed .mat contents in
+        .npy sidecar files.
+
+        The first load parses the MATLAB file and saves X and y next
+        to it; subsequent constructions memory-map the .npy files,
+        which skips the .mat parser entirely and lets the OS page
+        cache serve the arrays.
+
+        Returns:
+            An (X, y) tuple of numpy arrays.
+
+        """
+        x_cache = self.data_dir + ".X.npy"
+        y_cache = self.data_dir + ".y.npy"
+        if os.path.exists(x_cache) and os.path.exists(y_cache):
+            training_x = np.load(x_cache, mmap_mode='r')
+            training_y = np.load(y_cache, mmap_mode='r')
+        else:
+            data = io.loadmat(self.data_dir)
+            training_x = data.get('X')
+            training_y = data.get('y')
+            np.save(x_cache, training_x)
+            np.save(y_cache, training_y)
+        return training_x, training_y
 
     @staticmethod
     def plot_y_yhat_atom(y, y_hat):
@@ -128,6 +278,225 @@ class PotentialTrainer:
         plt.xlabel('y (eV/atom)', size=15)
         plt.show()
 
+    @staticmethod
+    def _ridge_path(gram, b, alpha_range):
+        """
+        Solve the ridge normal equations for a range of alpha.
+
+        With fit_intercept=False, ridge regression reduces to solving
+        (G + alpha I) w = b with G = X^T X and b = X^T y. G is
+        diagonalized once, so each additional alpha only costs two
+        small matrix-vector products instead of a full refit. Only the
+        lower triangle of gram is read.
+
+        Args:
+            gram (numpy.ndarray): Gram matrix of the training features.
+            b (numpy.ndarray): product of the transposed training
+                features with the labels.
+            alpha_range (list or numpy.array): a list of alpha values.
+
+        Returns:
+            A numpy ndarray of shape (n_features, n_alphas) holding one
+            coefficient vector per alpha.
+
+        """
+        eigenvalues, eigenvectors = np.linalg.eigh(gram)
+        vtb = eigenvectors.T @ b
+        alphas = np.asarray(alpha_range, dtype=float)
+        scaled = vtb[:, None] / (eigenvalues[:, None] + alphas[None, :])
+        return eigenvectors @ scaled
+
+    @staticmethod
+    def _ridge_solve(train_x, train_y, alpha):
+        """
+        Solve the ridge normal equations for a single alpha with
+        direct BLAS/LAPACK calls.
+
+        Forms the lower triangle of G = X^T X with syrk, shifts the
+        diagonal by alpha and solves via Cholesky factorization,
+        skipping the sklearn estimator dispatch and input validation
+        around what is a single linear solve.
+
+        Args:
+            train_x (numpy.ndarray): training feature matrix.
+            train_y (numpy.ndarray): training labels.
+            alpha (float): Constant that multiplies the penalization
+                term.
+
+        Returns:
+            A numpy array of fitted coefficients.
+
+        """
+        syrk, = linalg.blas.get_blas_funcs(('syrk',), (train_x,))
+        gram = syrk(1.0, train_x, trans=1, lower=1)
+        gram[np.diag_indices_from(gram)] += alpha
+        b = train_x.T @ train_y
+        factor = linalg.cho_factor(gram, lower=True, overwrite_a=True,
+                                   check_finite=False)
+        return linalg.cho_solve(factor, b, check_finite=False)
+
+    @staticmethod
+    def _ridge_fold(i, training_x, training_y, num_array, fold_id,
+                    alpha_range, gram_full, b_full, blas_threads=1,
+                    return_predictions=False):
+        """
+        Evaluate the full ridge alpha path on one fold of the 5-fold
+        split.
+
+        The fold's normal equations are obtained by downdating the
+        full-data Gram matrix with the validation block,
+        G_train = G_full - X_val^T X_val, so each fold only multiplies
+        its N/5 validation rows instead of its 4N/5 training rows.
+
+        Args:
+            i (int): fold index.
+            training_x (numpy.ndarray): shuffled feature matrix.
+            training_y (numpy.ndarray): shuffled labels.
+            num_array (numpy.ndarray): number of atoms in each sample.
+            fold_id (numpy.ndarray): fold index of each sample.
+            alpha_range (list or numpy.array): a list of alpha values.
+            gram_full (numpy.ndarray): lower-triangular Gram matrix of
+                the full feature matrix.
+            b_full (numpy.ndarray): product of the transposed full
+                feature matrix with the labels.
+            blas_threads (int): Number of BLAS threads the fold may use.
+            return_predictions (bool): Whether to return the train and
+                validation predictions along with the errors.
+
+        Returns:
+            An (errors_val, errors_train, predictions) tuple of
+            per-alpha error arrays, where predictions is a list of
+            per-alpha (predicted_train, predicted_validation) tuples
+            if requested and None otherwise.
+
+        """
+        val_mask = fold_id == i
+        train_mask = ~val_mask
+        train_y, validation_y = \
+            training_y[train_mask], training_y[val_mask]
+        num_array_train, num_array_val = \
+            num_array[train_mask], num_array[val_mask]
+        with threadpool_limits(limits=blas_threads, user_api="blas"):
+            validation_x = training_x[val_mask]
+            syrk, = linalg.blas.get_blas_funcs(('syrk',),
+                                               (validation_x,))
+            gram = gram_full - syrk(1.0, validation_x, trans=1, lower=1)
+            b = b_full - validation_x.T @ validation_y
+            coefs = PotentialTrainer._ridge_path(gram, b, alpha_range)
+            y_hat_all = training_x @ coefs
+        predicted_train = y_hat_all[train_mask]
+        predicted_validation = y_hat_all[val_mask]
+        errors_val = _path_errors(validation_y, predicted_validation,
+                                  num_array_val)
+        errors_train = _path_errors(train_y, predicted_train,
+                                    num_array_train)
+        predictions = None
+        if return_predictions:
+            predictions = [(predicted_train[:, j],
+                            predicted_validation[:, j])
+                           for j in range(len(alpha_range))]
+        return errors_val, errors_train, predictions
+
+    def _plot_fold_predictions(self, plot_image, training_y, num_array,
+                               fold_id, predicted_train,
+                               predicted_validation):
+        """
+        Draw the fold-0 y vs y_hat plots for one alpha.
+
+        Args:
+            plot_image (str): The type of image to plot.
+            training_y (numpy.ndarray): shuffled labels.
+            num_array (numpy.ndarray): number of atoms in each sample.
+            fold_id (numpy.ndarray): fold index of each sample.
+            predicted_train (numpy.ndarray): fold-0 train predictions.
+            predicted_validation (numpy.ndarray): fold-0 validation
+                predictions.
+
+        """
+        val_mask = fold_id == 0
+        train_mask = ~val_mask
+        train_y, validation_y = \
+            training_y[train_mask], training_y[val_mask]
+        num_array_train, num_array_val = \
+            num_array[train_mask], num_array[val_mask]
+        if plot_image == "atom":
+            self.plot_y_yhat_atom(train_y / num_array_train,
+                                  predicted_train / num_array_train)
+            self.plot_y_yhat_atom(validation_y / num_array_val,
+                                  predicted_validation / num_array_val)
+        if plot_image == "sample":
+            self.plot_y_yhat(train_y / num_array_train,
+                             predicted_train / num_array_train,
+                             num_array_train)
+            self.plot_y_yhat(validation_y / num_array_val,
+                             predicted_validation / num_array_val,
+                             num_array_val)
+
+    @staticmethod
+    def _fit_fold(f, i, training_x, training_y, num_array, fold_id,
+                  alpha_range, max_iter, tol, blas_threads=1,
+                  return_predictions=False):
+        """
+        Fit and evaluate the model on one fold of the 5-fold split for
+        every alpha.
+
+        A single estimator is constructed once and walked along the
+        alpha path with set_params, so the per-fit constructor and
+        attribute setup costs are paid once per fold.
+
+        Args:
+            f (func): training model function.
+            i (int): fold index.
+            training_x (numpy.ndarray): shuffled feature matrix.
+            training_y (numpy.ndarray): shuffled labels.
+            num_array (numpy.ndarray): number of atoms in each sample.
+            fold_id (numpy.ndarray): fold index of each sample.
+            alpha_range (list or numpy.array): a list of alpha values.
+            max_iter (int): The maximum number of iterations.
+            tol (int): The tolerance for the optimization.
+            blas_threads (int): Number of BLAS threads the fold may use.
+            return_predictions (bool): Whether to return the train and
+                validation predictions along with the errors.
+
+        Returns:
+            An (errors_val, errors_train, predictions) tuple of
+            per-alpha error arrays, where predictions is a list of
+            per-alpha (predicted_train, predicted_validation) tuples
+            if requested and None otherwise.
+
+        """
+        val_mask = fold_id == i
+        train_mask = ~val_mask
+        train_x = np.asfortranarray(training_x[train_mask])
+        train_y, validation_y = \
+            training_y[train_mask], training_y[val_mask]
+        num_array_train, num_array_val = \
+            num_array[train_mask], num_array[val_mask]
+        model = f(alpha=alpha_range[0], max_iter=max_iter, tol=tol,
+                  fit_intercept=False)
+        errors_val = np.empty(len(alpha_range))
+        errors_train = np.empty(len(alpha_range))
+        predictions = [] if return_predictions else None
+        with threadpool_limits(limits=blas_threads, user_api="blas"):
+            for j, alpha in enumerate(alpha_range):
+                model.set_params(alpha=alpha)
+                model.fit(train_x, train_y)
+                # One GEMV over the full matrix replaces separate
+                # train and validation predict dispatches.
+                y_hat_all = training_x @ np.ravel(model.coef_)
+                predicted_train = y_hat_all[train_mask]
+                predicted_validation = y_hat_all[val_mask]
+                errors_val[j] = _mean_abs_rel_err(validation_y,
+                                                  predicted_validation,
+                                                  num_array_val)
+                errors_train[j] = _mean_abs_rel_err(train_y,
+                                                    predicted_train,
+                                                    num_array_train)
+                if return_predictions:
+                    predictions.append((predicted_train,
+                                        predicted_validation))
+        return errors_val, errors_train, predictions
+
     def cross_validation(self, alpha_range, max_iter=1e6, tol=1e-4,
                          plot_image=None, seed=2020):
         """
@@ -141,54 +510,54 @@ class PotentialTrainer:
              seed (int): numpy random seed for shuffling data.
 
          """
-        data = self.training_data.copy()
-        np.random.seed(seed)
-        np.random.shuffle(data)
-        training_x = data[:, 1:]
-        training_y = data[:, 0]
-        num_array = data[:, 1]
+        rng = np.random.default_rng(seed)
+        perm = rng.permutation(len(self.training_y))
+        training_x = np.asfortranarray(self.training_x[perm])
+        training_y = self.training_y[perm].ravel()
+        num_array = training_x[:, 0]
+        fold_id = np.arange(len(training_y)) % 5
+        n_jobs = min(5, os.cpu_count())
+        blas_threads = self.blas_threads or max(1, os.cpu_count() // 5)
         alpha_errors = []
-        for alpha in alpha_range:
+        if self.f is MODELS["RIDGE"]:
+            # The full-data Gram matrix is shared by all folds; each
+            # worker downdates it with its own validation block.
+            with threadpool_limits(limits=self.blas_threads,
+                                   user_api="blas"):
+                syrk, = linalg.blas.get_blas_funcs(('syrk',),
+                                                   (training_x,))
+                gram_full = syrk(1.0, training_x, trans=1, lower=1)
+                b_full = training_x.T @ training_y
+            fold_results = Parallel(n_jobs=n_jobs)(
+                delayed(self._ridge_fold)(
+                    i, training_x, training_y, num_array, fold_id,
+                    alpha_range, gram_full, b_full,
+                    blas_threads=blas_threads,
+                    return_predictions=(i == 0 and plot_image is not None))
+                for i in range(5))
+        else:
+            fold_results = Parallel(n_jobs=n_jobs)(
+                delayed(self._fit_fold)(
+                    self.f, i, training_x, training_y, num_array,
+                    fold_id, alpha_range, max_iter, tol,
+                    blas_threads=blas_threads,
+                    return_predictions=(i == 0 and plot_image is not None))
+                for i in range(5))
+        errors_validation = np.array([result[0] for result in fold_results])
+        errors_train = np.array([result[1] for result in fold_results])
+        for j, alpha in enumerate(alpha_range):
             print(r"5-fold error with alpha = {}".format(alpha))
-            errors_validation = []
-            errors_train = []
-            for i in range(5):
-                all_id = list(range(len(data)))
-                validation_id = all_id[i::5]
-                train_id = [i for i in all_id if i not in validation_id]
-                train_x, train_y = training_x[train_id], training_y[train_id]
-                validation_x,  validation_y = \
-                    training_x[validation_id],  training_y[validation_id]
-                num_array_train, num_array_val = \
-                    num_array[train_id], num_array[validation_id]
-                model = self.f(alpha=alpha, max_iter=max_iter, tol=tol,
-                               fit_intercept=False)
-                model.fit(train_x, train_y)
-                predicted_validation = model.predict(validation_x)
-                predicted_train = model.predict(train_x)
-                diff_val = np.absolute(validation_y - predicted_validation)
-                error_val = np.average(diff_val / num_array_val)
-                diff_train = np.absolute(train_y - predicted_train)
-                error_train = np.average(diff_train / num_array_train)
-                if i == 0 and plot_image == "atom":
-                    self.plot_y_yhat_atom(train_y / num_array_train,
-                                          predicted_train / num_array_train)
-                    self.plot_y_yhat_atom(validation_y / num_array_val,
-                                          predicted_validation / num_array_val)
-                if i == 0 and plot_image == "sample":
-                    self.plot_y_yhat(train_y / num_array_train,
-                                     predicted_train / num_array_train,
-                                     num_array_train)
-                    self.plot_y_yhat(validation_y / num_array_val,
-                                     predicted_validation / num_array_val,
-                                     num_array_val)
-                errors_validation.append(error_val)
-                errors_train.append(error_train)
-            mean_train_e = np.mean(errors_train)
-            mean_val_e = np.mean(errors_validation)
+            if plot_image:
+                predicted_train, predicted_validation = fold_results[0][2][j]
+                self._plot_fold_predictions(plot_image, training_y,
+                                            num_array, fold_id,
+                                            predicted_train,
+                                            predicted_validation)
+            mean_train_e = np.mean(errors_train[:, j])
+            mean_val_e = np.mean(errors_validation[:, j])
             print("Mean error train: {} eV/atom".format(mean_train_e))
             print("Mean error validaiton: {} eV/atom".format(mean_val_e))
-            alpha_errors.append(np.mean(errors_validation))
+            alpha_errors.append(mean_val_e)
         alpha_errors = np.array(alpha_errors)
         max_e = max(alpha_errors)
         min_e = min(alpha_errors)
@@ -228,15 +597,25 @@ class PotentialTrainer:
              tol (int): The tolerance for the optimization.
 
          """
-        model = self.f(alpha=alpha, max_iter=max_iter, tol=tol,
-                       fit_intercept=False)
-        model.fit(self.training_x, self.training_y)
-        potential = model.coef_[0]
+        if self.f is MODELS["RIDGE"]:
+            with threadpool_limits(limits=self.blas_threads,
+                                   user_api="blas"):
+                potential = self._ridge_solve(self.training_x,
+                                              np.ravel(self.training_y),
+                                              alpha)
+        else:
+            model = self.f(alpha=alpha, max_iter=max_iter, tol=tol,
+                           fit_intercept=False)
+            with threadpool_limits(limits=self.blas_threads,
+                                   user_api="blas"):
+                model.fit(self.training_x, self.training_y)
+            potential = np.ravel(model.coef_)
         print("Fitted potential: ", potential)
         if self.norm:
-            potential = potential / self.norms
+            # Only the feature block was normalized; the leading
+            # atom-count coefficient keeps its scale.
+            potential = np.concatenate((potential[:1],
+                                        potential[1:] / self.norms))
             print("Fitted unnormalized potential: ", potential)
-        with open(os.path.join(output_dir, "re_potential"), 'w') as f:
-            for i in range(len(potential)):
-                f.write(str(potential[i]) + "\n")
-            f.close()
+        np.savetxt(os.path.join(output_dir, "re_potential"), potential,
+                   fmt="%.17g")
@@ -10,8 +10,11 @@ if __name__ == "__main__":
         version='2020.5.5',
         packages=find_packages(),
         install_requires=["tqdm", "pymatgen", "matplotlib", "scikit-learn",
-                          "numpy", "scipy", "monty"],
-        optional_requires={"make_feature": ["ase", "lammps"]},
+                          "numpy", "scipy", "monty", "joblib",
+                          "threadpoolctl"],
+        optional_requires={"make_feature": ["ase", "lammps"],
+                           "accelerate": ["scikit-learn-intelex",
+                                          "numba"]},
         description='Repository for training Re potential',
         python_requires='>=3.6'
     )